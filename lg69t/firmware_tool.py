@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import json
+import mmap
 import os
 import struct
 import sys
@@ -10,6 +12,7 @@ import typing
 import urllib.error
 import urllib.request
 import zlib
+from collections import deque
 from enum import Enum, auto
 from zipfile import ZipFile
 
@@ -38,11 +41,27 @@ MSG_ID_SEND_FIRMWARE = b'\x04'
 APP_FLASH_OFFSET = 0x20000
 
 PACKET_SIZE = 1024 * 5
+# The message length field is 16 bits, and includes the 4-byte sequence number.
+MAX_PACKET_SIZE = 0xFFFF - 4
 
 RESPONSE_PAYLOAD_SIZE = 4
 HEADER = b'\xAA'
 TAIL = b'\x55'
 
+# Header + class ID + message ID + payload length, and CRC + tail.
+MESSAGE_PREFIX_SIZE = 5
+MESSAGE_SUFFIX_SIZE = 5
+
+_LENGTH_STRUCT = struct.Struct('>H')
+_U32_STRUCT = struct.Struct('>I')
+# Header, class ID, message ID, payload size, payload class ID, payload message ID, response code, CRC, tail. Only the
+# fields that are checked are unpacked.
+_RESPONSE_STRUCT = struct.Struct('>3xHBBHIx')
+_RESPONSE_SIZE = _RESPONSE_STRUCT.size
+_APP_INFO_STRUCT = struct.Struct('>IIIB3x')
+_GNSS_INFO_STRUCT = struct.Struct('>IIIIIIBBB5x')
+_FIRMWARE_LENGTH_STRUCT = struct.Struct('<I')
+
 
 def _send_fe_and_wait(ser: Serial, request: MessagePayload, expected_response_type: MessageType,
                       timeout: float = 1.0, repeat_interval: float = 0.5) -> MessagePayload:
@@ -50,16 +69,19 @@ def _send_fe_and_wait(ser: Serial, request: MessagePayload, expected_response_ty
     data = encoder.encode_message(request)
 
     decoder = FusionEngineDecoder()
-    start_time = time.time()
-    last_send_time = 0
-    while time.time() < start_time + timeout:
+    # Use a monotonic clock so the deadline is not affected by system clock adjustments.
+    deadline = time.monotonic() + timeout
+    ser.timeout = 0.1
+    last_send_time = None
+    while time.monotonic() < deadline:
         # Send the request once immediately, then again every N seconds if we haven't gotten a response.
-        if time.time() > last_send_time + repeat_interval:
+        if last_send_time is None or time.monotonic() > last_send_time + repeat_interval:
             ser.write(data)
-            last_send_time = time.time()
+            last_send_time = time.monotonic()
 
-        # Read all incoming data and wait for the expected response type.
-        messages = decoder.on_data(ser.read_all())
+        # Read all incoming data and wait for the expected response type. If nothing is available, block for up to
+        # the port timeout for more data to arrive rather than polling in a tight loop.
+        messages = decoder.on_data(ser.read(max(ser.in_waiting, 1)))
         for header, payload in messages:
             if header.message_type == expected_response_type:
                 return payload
@@ -89,38 +111,66 @@ def send_reboot(ser: Serial, timeout: float = 10.0, reboot_flag: int = ResetRequ
             return False
 
 
-def synchronize(ser: Serial, timeout=10.0):
-    start_time = time.time()
+def set_low_latency(ser: Serial) -> bool:
+    # By default, Linux USB-serial drivers (FTDI in particular) hold received data for up to 16 ms before passing it
+    # on, which adds delay to every sync and response exchange. Request low latency mode (ASYNC_LOW_LATENCY) where
+    # supported. For FTDI adapters, the driver also reduces the adapter's latency timer to 1 ms.
+    #
+    # This is best effort, so failure here is not an error. pyserial only implements low latency mode on Linux: the
+    # Windows port class does not have the method at all, and other POSIX platforms raise NotImplementedError. Not all
+    # Linux drivers support it either.
+    if not hasattr(ser, 'set_low_latency_mode'):
+        return False
+
+    try:
+        ser.set_low_latency_mode(True)
+        return True
+    except (OSError, ValueError, NotImplementedError):
+        return False
+
+
+def synchronize(ser: Serial, timeout=10.0, repeat_interval: float = 0.05):
+    deadline = time.monotonic() + timeout
     ser.timeout = 0.05
-    resp_data = b'\x00\x00\x00\x00'
-    while time.time() < start_time + timeout:
-        ser.write(SYNC_WORD1_BYTES)
-        c = ser.read()
-        while len(c) > 0:
-            resp_data = resp_data[1:] + c
-            if resp_data == RSP_WORD1_BYTES:
-                ser.write(SYNC_WORD2_BYTES)
-                resp_data = ser.read(4)
-                if len(resp_data) == 4 and resp_data == RSP_WORD2_BYTES:
-                    return True
-            c = ser.read()
+    resp_data = bytearray()
+    last_send_time = None
+    while time.monotonic() < deadline:
+        # Send the sync word every N seconds until the device responds.
+        if last_send_time is None or time.monotonic() > last_send_time + repeat_interval:
+            ser.write(SYNC_WORD1_BYTES)
+            last_send_time = time.monotonic()
+
+        # Read everything that's available (waiting up to the port timeout for at least one byte) and search the
+        # accumulated data for the response word, rather than reading and comparing one byte at a time.
+        c = ser.read(max(ser.in_waiting, 1))
+        if len(c) == 0:
+            continue
+
+        resp_data += c
+        if resp_data.find(RSP_WORD1_BYTES) >= 0:
+            ser.write(SYNC_WORD2_BYTES)
+            c = ser.read(4)
+            if c == RSP_WORD2_BYTES:
+                return True
+            # Otherwise, resume searching from the unexpected response.
+            resp_data = bytearray(c)
+
+        # Keep just enough trailing data to detect a response word split across reads.
+        del resp_data[:-(len(RSP_WORD1_BYTES) - 1)]
     return False
 
 
 def get_response(class_id: bytes, msg_id: bytes, ser: Serial, timeout=60):
-    response_fmt = '>BBBHBBHIB'
-    response_size = struct.calcsize(response_fmt)
-
     ser.timeout = timeout
-    data = ser.read(response_size)
-    if len(data) < response_size:
+    data = ser.read(_RESPONSE_SIZE)
+    if len(data) < _RESPONSE_SIZE:
         print('Timeout waiting for response')
         return False
 
-    _, _, _, read_payload_size, read_class_id, read_msg_id, response, crc, _ = struct.unpack(
-        response_fmt, data)
+    read_payload_size, read_class_id, read_msg_id, response, crc = _RESPONSE_STRUCT.unpack_from(data)
 
-    calculated_crc = zlib.crc32(data[1:-5])
+    with memoryview(data) as view:
+        calculated_crc = zlib.crc32(view[1:-5])
 
     if RESPONSE_PAYLOAD_SIZE != read_payload_size:
         print(
@@ -149,42 +199,147 @@ def get_response(class_id: bytes, msg_id: bytes, ser: Serial, timeout=60):
     return True
 
 
-def encode_message(class_id: bytes, msg_id: bytes, payload: bytes):
-    data = class_id + msg_id + struct.pack('>H', len(payload)) + payload
-    crc = struct.pack('>I', zlib.crc32(data))
-    return HEADER + data + crc + TAIL
-
-
-def encode_app_info(firmware_data):
-    app_info_fmt = '>IIIB3x'
-    fw_crc = zlib.crc32(struct.pack('<I', len(firmware_data)) + firmware_data)
-    payload_data = struct.pack(app_info_fmt, len(
-        firmware_data), fw_crc, APP_FLASH_OFFSET, 0x01)
-    return encode_message(CLASS_APP, MSG_ID_FIRMWARE_INFO, payload_data)
-
-
-def encode_gnss_info(firmware_data):
-    gnss_info_fmt = '>IIIIIIBBB5x'
-    fw_crc = zlib.crc32(struct.pack('<I', len(firmware_data)) + firmware_data)
-    payload_data = struct.pack(gnss_info_fmt, len(
-        firmware_data), fw_crc, 0x10000000, 0x00000400, 0x00180000, 0x00080000, 0x01, 0x00, 0x00)
-    return encode_message(CLASS_GNSS, MSG_ID_FIRMWARE_INFO, payload_data)
-
-
-def send_firmware(ser: Serial, class_id: bytes, firmware_data):
+def encode_message(class_id: bytes, msg_id: bytes, payload: typing.Union[bytes, memoryview]) -> bytearray:
+    # Pack the message directly into a buffer of the final size rather than concatenating the individual fields.
+    payload_len = len(payload)
+    crc_offset = MESSAGE_PREFIX_SIZE + payload_len
+    buffer = bytearray(crc_offset + MESSAGE_SUFFIX_SIZE)
+    buffer[0] = HEADER[0]
+    buffer[1] = class_id[0]
+    buffer[2] = msg_id[0]
+    _LENGTH_STRUCT.pack_into(buffer, 3, payload_len)
+    buffer[MESSAGE_PREFIX_SIZE:crc_offset] = payload
+    with memoryview(buffer) as view:
+        _U32_STRUCT.pack_into(buffer, crc_offset, zlib.crc32(view[1:crc_offset]))
+    buffer[-1] = TAIL[0]
+    return buffer
+
+
+def read_firmware(bin_file: typing.BinaryIO, chunk_size: int = 64 * 1024) -> typing.Union[bytearray, mmap.mmap]:
+    # If the image is a regular file, memory-map it instead of reading it. The CRC calculation and packet slicing both
+    # work directly on the mapping, so the image is never copied into memory. The mapping is released once the caller
+    # drops its reference.
+    try:
+        return mmap.mmap(bin_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Files inside a .p1fw archive do not have a file descriptor, and empty files cannot be mapped.
+        pass
+
+    # Otherwise, read the image in chunks directly into a single buffer. Calling read() with no size on a file from a
+    # .p1fw archive decompresses into a list of blocks that are then joined, briefly holding two copies of the image.
+    firmware_data = bytearray()
+    while True:
+        chunk = bin_file.read(chunk_size)
+        if not chunk:
+            break
+        firmware_data += chunk
+    return firmware_data
+
+
+def calculate_firmware_crc(firmware_data) -> int:
+    # The firmware CRC covers the little-endian image length followed by the image itself. Seed the image CRC with the
+    # CRC of the length instead of concatenating the two, which would copy the entire image.
+    return zlib.crc32(firmware_data, zlib.crc32(_FIRMWARE_LENGTH_STRUCT.pack(len(firmware_data))))
+
+
+# The info messages depend only on the image length and CRC, so they can be reused if the same image is sent again.
+# They are returned as bytes since the cached value is shared.
+@functools.lru_cache(maxsize=4)
+def encode_app_info(fw_len: int, fw_crc: int) -> bytes:
+    payload_data = _APP_INFO_STRUCT.pack(fw_len, fw_crc, APP_FLASH_OFFSET, 0x01)
+    return bytes(encode_message(CLASS_APP, MSG_ID_FIRMWARE_INFO, payload_data))
+
+
+@functools.lru_cache(maxsize=4)
+def encode_gnss_info(fw_len: int, fw_crc: int) -> bytes:
+    payload_data = _GNSS_INFO_STRUCT.pack(fw_len, fw_crc, 0x10000000, 0x00000400, 0x00180000, 0x00080000,
+                                          0x01, 0x00, 0x00)
+    return bytes(encode_message(CLASS_GNSS, MSG_ID_FIRMWARE_INFO, payload_data))
+
+
+def send_firmware(ser: Serial, class_id: bytes, firmware_data, window_size: int = 1,
+                  packet_size: int = PACKET_SIZE):
+    # Step through the image using a memoryview so each packet slice refers to the original buffer instead of copying
+    # the remaining data on every iteration.
+    #
+    # Up to window_size packets may be written before waiting for the oldest one to be acknowledged, so the device can
+    # start on the next packet while we wait for the previous response. The responses are buffered by the serial
+    # driver and checked in order. A window size of 1 is plain stop-and-wait, which the bootloader always supports.
+    if window_size < 1:
+        raise ValueError(f'Window size must be at least 1. [window_size={window_size}]')
+
+    if packet_size < 1 or packet_size > MAX_PACKET_SIZE:
+        raise ValueError(f'Packet size must be between 1 and {MAX_PACKET_SIZE} bytes. [packet_size={packet_size}]')
+
+    firmware_view = memoryview(firmware_data)
+    total_len = len(firmware_view)
+
+    # Build every packet in the same preallocated buffer. The header fields that don't change are set once, and each
+    # packet only fills in its length, sequence number, data, CRC, and tail. The final packet may be shorter than the
+    # others, so only the used portion of the buffer is written. serial.write() has finished with the data by the time
+    # it returns, so the buffer can be reused even while earlier packets are awaiting a response.
+    data_offset = MESSAGE_PREFIX_SIZE + _U32_STRUCT.size
+    packet = bytearray(data_offset + packet_size + MESSAGE_SUFFIX_SIZE)
+    packet[0] = HEADER[0]
+    packet[1] = class_id[0]
+    packet[2] = MSG_ID_SEND_FIRMWARE[0]
+    packet_view = memoryview(packet)
+    # The class and message IDs are the same for every packet, so their contribution to the CRC is also fixed.
+    # Calculate it once and use it as the starting value for each packet's CRC.
+    header_crc = zlib.crc32(packet_view[1:3])
+
+    # Bind everything used per packet to locals to avoid repeated global and attribute lookups in the loop below.
+    write = ser.write
+    crc32 = zlib.crc32
+    pack_length = _LENGTH_STRUCT.pack_into
+    pack_u32 = _U32_STRUCT.pack_into
+    seq_size = _U32_STRUCT.size
+    tail = TAIL[0]
+    tail_offset = MESSAGE_SUFFIX_SIZE - 1
+
+    offset = 0
+    acked_len = 0
+    last_percent = -1
+    last_print_time = None
     sequence_num = 0
-    total_len = len(firmware_data)
-    while len(firmware_data) > 0:
-        data = encode_message(class_id, MSG_ID_SEND_FIRMWARE, struct.pack(
-            '>I', sequence_num) + firmware_data[:PACKET_SIZE])
-        ser.write(data)
-        if not get_response(class_id, MSG_ID_SEND_FIRMWARE, ser):
-            print()
-            return False
-        firmware_data = firmware_data[PACKET_SIZE:]
-        sequence_num += 1
-        print(
-            f'\r{int((total_len - len(firmware_data))/total_len * 100.):02d}%', end='')
+    in_flight = deque()
+    # The size of the packet currently built in the buffer and waiting to be sent, or 0 if there isn't one.
+    pending_size = 0
+    while acked_len < total_len:
+        # Build the next packet as soon as the buffer is free. That way it's built while the device is still working
+        # on the previous packet, and it can be sent as soon as the response arrives.
+        if pending_size == 0 and offset < total_len:
+            chunk = firmware_view[offset:offset + packet_size]
+            chunk_len = len(chunk)
+            crc_offset = data_offset + chunk_len
+            pack_length(packet, 3, seq_size + chunk_len)
+            pack_u32(packet, MESSAGE_PREFIX_SIZE, sequence_num)
+            packet_view[data_offset:crc_offset] = chunk
+            pack_u32(packet, crc_offset, crc32(packet_view[3:crc_offset], header_crc))
+            packet[crc_offset + tail_offset] = tail
+            pending_size = crc_offset + MESSAGE_SUFFIX_SIZE
+            offset += chunk_len
+            sequence_num += 1
+
+        if pending_size > 0 and len(in_flight) < window_size:
+            write(packet_view[:pending_size])
+            in_flight.append(chunk_len)
+            pending_size = 0
+        else:
+            if not get_response(class_id, MSG_ID_SEND_FIRMWARE, ser):
+                print()
+                return False
+            acked_len += in_flight.popleft()
+            # Only update the progress display when the percentage actually changes, and at most 10 times per second
+            # (always displaying the final value).
+            percent = acked_len * 100 // total_len
+            if percent != last_percent:
+                now = time.monotonic()
+                if last_print_time is None or now - last_print_time >= 0.1 or acked_len == total_len:
+                    sys.stdout.write(f'\r{percent:02d}%')
+                    sys.stdout.flush()
+                    last_percent = percent
+                    last_print_time = now
     print()
     return True
 
@@ -195,7 +350,7 @@ class UpgradeType(Enum):
 
 
 def Upgrade(ser: Serial, bin_file: typing.BinaryIO, upgrade_type: UpgradeType, should_send_reboot: bool,
-            wait_for_reboot: bool = False):
+            wait_for_reboot: bool = False, window_size: int = 1, packet_size: int = PACKET_SIZE):
     class_id = {
         UpgradeType.APP: CLASS_APP,
         UpgradeType.GNSS: CLASS_GNSS,
@@ -230,13 +385,15 @@ def Upgrade(ser: Serial, bin_file: typing.BinaryIO, upgrade_type: UpgradeType, s
     if not get_response(class_id, MSG_ID_FIRMWARE_ADDRESS, ser):
         return False
 
-    firmware_data = bin_file.read()
+    firmware_data = read_firmware(bin_file)
+    fw_len = len(firmware_data)
+    fw_crc = calculate_firmware_crc(firmware_data)
 
     print('Sending firmware info.')
     if upgrade_type == UpgradeType.GNSS:
-        ser.write(encode_gnss_info(firmware_data))
+        ser.write(encode_gnss_info(fw_len, fw_crc))
     else:
-        ser.write(encode_app_info(firmware_data))
+        ser.write(encode_app_info(fw_len, fw_crc))
     if not get_response(class_id, MSG_ID_FIRMWARE_INFO, ser):
         return False
 
@@ -247,7 +404,7 @@ def Upgrade(ser: Serial, bin_file: typing.BinaryIO, upgrade_type: UpgradeType, s
         return False
 
     print('Sending data...')
-    if send_firmware(ser, class_id, firmware_data) is True:
+    if send_firmware(ser, class_id, firmware_data, window_size=window_size, packet_size=packet_size) is True:
         print('Update successful.')
         if should_send_reboot:
             # Send a no-op reset request message and wait for a response. This won't actually restart the device,
@@ -271,9 +428,11 @@ def Upgrade(ser: Serial, bin_file: typing.BinaryIO, upgrade_type: UpgradeType, s
 
 
 def print_bytes(byte_data):
-    print(", ".join(
-        [f'0x{c:02X}' for c in byte_data]
-    ))
+    # Format the bytes with hex() rather than formatting each byte individually.
+    if len(byte_data) > 0:
+        print('0x' + bytes(byte_data).hex(' ').upper().replace(' ', ', 0x'))
+    else:
+        print()
 
 
 def extract_fw_files(p1fw):
@@ -282,7 +441,8 @@ def extract_fw_files(p1fw):
     if isinstance(p1fw, ZipFile):
         # Extract filenames from info.json file.
         if 'info.json' in p1fw.namelist():
-            info_json = json.load(p1fw.open('info.json', 'r'))
+            with p1fw.open('info.json', 'r') as f:
+                info_json = json.load(f)
 
             app_filename = info_json['fusion_engine']['filename']
             gnss_filename = info_json['gnss_receiver']['filename']
@@ -299,7 +459,8 @@ def extract_fw_files(p1fw):
         if os.path.exists(os.path.join(p1fw, 'info.json')):
             # Extract filenames from info.json file.
             info_json_path = os.path.join(p1fw, 'info.json')
-            info_json = json.load(open(info_json_path))
+            with open(info_json_path) as f:
+                info_json = json.load(f)
 
             app_filename = info_json['fusion_engine']['filename']
             gnss_filename = info_json['gnss_receiver']['filename']
@@ -414,21 +575,41 @@ Update only the application software (not common):
 
     device = parser.add_argument_group('Device Options')
     device.add_argument('--port', type=str, default='/dev/ttyUSB1', help="The serial port of the device.")
+    device.add_argument('--baud', type=int, default=460800,
+                        help="The serial baud rate to use. This must match the baud rate configured on the device.")
+    device.add_argument('--rtscts', action='store_true',
+                        help="Enable RTS/CTS hardware flow control. Requires the flow control lines to be connected.")
 
     advanced = parser.add_argument_group('Advanced Options')
     advanced.add_argument('--gnss', type=str, metavar="FILE", default=None,
                           help="The path to the GNSS (Teseo) firmware .bin file to be loaded.")
     advanced.add_argument('--app', type=str, metavar="FILE", default=None,
                           help="The path to the application firmware .bin file to be loaded.")
+    advanced.add_argument('--window-size', type=int, default=1,
+                          help="The maximum number of firmware packets to send before waiting for a response. Values "
+                               "larger than 1 overlap transmission with the device's processing of earlier packets, "
+                               "but require a bootloader that accepts back-to-back packets.")
+    advanced.add_argument('--packet-size', type=int, default=PACKET_SIZE,
+                          help="The number of firmware bytes to send in each packet. Larger packets require fewer "
+                               "responses from the device, but must not exceed the maximum packet size supported by "
+                               "the bootloader.")
 
     args = parser.parse_args()
 
+    if args.window_size < 1:
+        print('Window size must be at least 1.')
+        sys.exit(1)
+
+    if args.packet_size < 1 or args.packet_size > MAX_PACKET_SIZE:
+        print(f'Packet size must be between 1 and {MAX_PACKET_SIZE} bytes.')
+        sys.exit(1)
+
     port_name = args.port
     should_send_reboot = not args.manual_reboot
 
     # Show software versions and exit.
     if args.show:
-        with Serial(port_name, baudrate=460800) as ser:
+        with Serial(port_name, baudrate=args.baud, rtscts=args.rtscts) as ser:
             version_info = query_version_info(ser, timeout=2.0)
             if version_info is None:
                 print('Version query timed out.')
@@ -540,7 +721,9 @@ Update only the application software (not common):
 
     # Perform the software update.
     print(f"Starting upgrade on device {port_name}.")
-    with Serial(port_name, baudrate=460800) as ser:
+    with Serial(port_name, baudrate=args.baud, rtscts=args.rtscts) as ser:
+        set_low_latency(ser)
+
         # If we have version information from a .p1fw file, query the software versions on the device and skip
         # unnecessary updates. If the device is not running, this query will fail and we'll go ahead and update
         # everything.
@@ -563,7 +746,8 @@ Update only the application software (not common):
             else:
                 print('Upgrading GNSS firmware...')
                 if not Upgrade(ser, gnss_bin_fd, UpgradeType.GNSS, should_send_reboot,
-                               wait_for_reboot=app_bin_fd is not None):
+                               wait_for_reboot=app_bin_fd is not None, window_size=args.window_size,
+                               packet_size=args.packet_size):
                     sys.exit(2)
 
         # Update the application software.
@@ -578,7 +762,8 @@ Update only the application software (not common):
                 print('Application software already up to date (%s). Skipping.' % version_info.engine_version_str)
             else:
                 print('Upgrading application software...')
-                if not Upgrade(ser, app_bin_fd, UpgradeType.APP, should_send_reboot):
+                if not Upgrade(ser, app_bin_fd, UpgradeType.APP, should_send_reboot, window_size=args.window_size,
+                               packet_size=args.packet_size):
                     sys.exit(2)
 
 